@@ -7,15 +7,29 @@ Command-line utility to produce a fair sample of a set of files.
 """
 
 import argparse
+import collections
+import concurrent.futures
+import ctypes
+import functools
 import heapq
+import itertools
 import math
+import mmap
 import os
 import random
 import re
 import shlex
+import shutil
+import stat
+import struct
 import sys
 import zipfile
 
+try:
+    import numpy as np
+except ImportError:  # optional: stage2_sample falls back to pure Python
+    np = None
+
 HELP_TEXT = """mksample filename+ [ arguments ]
 
 Produces a fair sample of a set of files. See https://github.com/gafter/mksample/blob/main/README.md
@@ -47,14 +61,30 @@ arguments:
         Zip files contained within zip files are ignored.
     --count n
         Designate the number of samples to be produced. 1 <= n <= 2500
+    --seed n
+        Seeds the random number generator so that the same files produce the same sample.
 """
 
 SKIP_BASENAME_DIR = "@eaDir"
+_EADIR_LEN = len(SKIP_BASENAME_DIR)
 MKSAMPLE_SKIP_FILE = ".mksample.skip"
 # Private Use character U+E000: unlikely to appear in file names
 ZIP_SEP = "\uE000"
 # Avoid log(0) in Efraimidis-Spirakis
 RANDOM_EPSILON = 2**-1074
+# Zip central directory signatures and fixed record sizes (APPNOTE.TXT)
+_ZIP_CD_SIG = 0x02014B50
+_ZIP_CD_SIZE = 46
+_ZIP_EOCD_SIG = b"PK\x05\x06"
+_ZIP_EOCD_SIZE = 22
+_ZIP_EOCD64_SIG = b"PK\x06\x06"
+_ZIP_EOCD64_SIZE = 56
+_ZIP_EOCD64_LOCATOR_SIG = b"PK\x06\x07"
+_ZIP_EOCD64_LOCATOR_SIZE = 20
+# Buffer size for copying file contents in stage 3
+COPY_BUFFER_SIZE = 1024 * 1024
+# Candidates whose keys are computed per NumPy call in stage 2
+SAMPLE_CHUNK_SIZE = 65536
 
 
 def parse_args(argv):
@@ -72,6 +102,7 @@ def parse_args(argv):
     parser.add_argument("--uniform", action="store_true", help="Uniform weight per file")
     parser.add_argument("--zip", action="store_true", help="Consider contents of zip files")
     parser.add_argument("--count", type=int, default=2500, metavar="n", help="Number of samples (1-2500, default 2500)")
+    parser.add_argument("--seed", type=int, default=None, metavar="n", help="Seed for the random number generator")
     args = parser.parse_args(argv)
 
     if args.include_patterns is None:
@@ -82,25 +113,33 @@ def parse_args(argv):
         args.size = False
     if not (1 <= args.count <= 2500):
         parser.error("--count must be between 1 and 2500")
+    if args.seed is not None and args.seed < 0:
+        parser.error("--seed must be non-negative")
 
     return args
 
 
-def _basename(path):
-    """Last path component. For zip_path⟨ZIP_SEP⟩member use the member part."""
-    if ZIP_SEP in path:
-        path = path.split(ZIP_SEP, 1)[1]
+def _basename_fs(path):
+    """Last path component of a filesystem path."""
     return os.path.basename(path) or "unnamed"
 
 
+def _basename_zip(member_path):
+    """Last path component of a zip member path (the part after ZIP_SEP)."""
+    return member_path.rpartition("/")[2] or "unnamed"
+
+
+_SANITIZE_TABLE = str.maketrans({c: "_" for c in "\0/\\\n\r"})
+
+
 def _sanitize_dest_basename(base):
     """Replace path separators, NUL, and newlines so the destination name is safe."""
-    return base.replace("\0", "_").replace("/", "_").replace("\\", "_").replace("\n", "_").replace("\r", "_")
+    return base.translate(_SANITIZE_TABLE)
 
 
 def _should_skip_traversal(basename, exclude_re):
     """Skip directories and zip containers if hidden, @eaDir, or excluded."""
-    if basename.startswith(".") or basename == SKIP_BASENAME_DIR:
+    if not basename or basename[0] == "." or (len(basename) == _EADIR_LEN and basename == SKIP_BASENAME_DIR):
         return True
     if exclude_re and exclude_re.search(basename) is not None:
         return True
@@ -109,19 +148,23 @@ def _should_skip_traversal(basename, exclude_re):
 
 def _should_skip_file_basename(basename, exclude_re, include_re):
     """Skip file (or zip member) if hidden, @eaDir, excluded, or not included."""
-    if basename.startswith(".") or basename == SKIP_BASENAME_DIR:
-        return True
-    if exclude_re and exclude_re.search(basename) is not None:
+    if not basename or basename[0] == "." or (len(basename) == _EADIR_LEN and basename == SKIP_BASENAME_DIR):
         return True
-    if include_re.search(basename) is None:
+    if exclude_re and exclude_re.match(basename) is not None:
         return True
-    return False
+    return include_re.match(basename) is None
 
 
 def _compile_patterns(patterns, option_name="pattern"):
     """Compile list of regex pattern strings to one fullmatch regex."""
     if not patterns:
         return None
+    return _compile_patterns_cached(tuple(patterns), option_name)
+
+
+@functools.lru_cache(maxsize=32)
+def _compile_patterns_cached(patterns, option_name):
+    """_compile_patterns for a tuple of patterns, memoized for repeated runs in one process."""
     try:
         combined = "|".join(f"(?:{p})" for p in patterns)
         return re.compile(f"^(?:{combined})$")
@@ -130,91 +173,448 @@ def _compile_patterns(patterns, option_name="pattern"):
         sys.exit(1)
 
 
-def stage1_collect_candidates(args):
-    """Produce list of (weight, path) where path may be 'zip_path' + ZIP_SEP + 'member' for zip entries."""
-    exclude_re = _compile_patterns(args.exclude_patterns, "--exclude") if args.exclude_patterns else None
-    include_re = _compile_patterns(args.include_patterns, "--include")
-    candidates = []
+def _scandir_entries(path, want_size):
+    """Yield (name, path, is_dir, is_file, size) for each entry of directory path using os.scandir.
 
-    def visit(path):
-        basename = _basename(path)
-        if os.path.isdir(path) and ZIP_SEP not in path:
-            if _should_skip_traversal(basename, exclude_re):
-                return
-            if os.path.isfile(os.path.join(path, MKSAMPLE_SKIP_FILE)):
-                return
+    is_dir does not follow symlinks; is_file does. size is 0 unless want_size and is_file.
+    """
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                yield entry.name, entry.path, True, False, 0
+                continue
+            size = 0
             try:
-                for name in os.listdir(path):
-                    visit(os.path.join(path, name))
+                is_file = entry.is_file()
+                if is_file and want_size:
+                    size = entry.stat().st_size
             except OSError:
-                pass
-            return
-        if args.zip and path.lower().endswith(".zip") and os.path.isfile(path):
-            if _should_skip_traversal(basename, exclude_re):
-                return
-            try:
-                with zipfile.ZipFile(path, "r") as zf:
-                    for info in zf.infolist():
-                        member_path = info.filename.rstrip("/")
-                        if not member_path:
-                            continue
-                        member_basename = os.path.basename(member_path) or "unnamed"
-                        if _should_skip_file_basename(member_basename, exclude_re, include_re):
-                            continue
-                        if info.is_dir():
-                            continue
-                        k = info.file_size if args.size else 1
-                        if k < 0:
-                            k = 0
-                        if args.size and k <= 0:
-                            continue
-                        candidates.append((k, path + ZIP_SEP + member_path))
-            except (zipfile.BadZipFile, OSError):
-                pass
-            return
-        if os.path.isfile(path) or (os.path.islink(path) and not os.path.isdir(path)):
-            if _should_skip_file_basename(basename, exclude_re, include_re):
-                return
-            k = os.path.getsize(path) if args.size else 1
-            if k < 0:
-                k = 0
-            if args.size and k <= 0:
+                # Broken symlink, vanished file, etc.
+                is_file = False
+            yield entry.name, entry.path, False, is_file, size
+
+
+# getattrlistbulk(2) constants from <sys/attr.h> and <sys/vnode.h>
+_ATTR_BIT_MAP_COUNT = 5
+_ATTR_CMN_NAME = 0x00000001
+_ATTR_CMN_OBJTYPE = 0x00000008
+_ATTR_CMN_RETURNED_ATTRS = 0x80000000
+_ATTR_FILE_DATALENGTH = 0x00000200
+_VREG = 1
+_VDIR = 2
+_VLNK = 5
+_BULK_BUFFER_SIZE = 256 * 1024
+
+
+class _AttrList(ctypes.Structure):
+    _fields_ = [
+        ("bitmapcount", ctypes.c_ushort),
+        ("reserved", ctypes.c_uint16),
+        ("commonattr", ctypes.c_uint32),
+        ("volattr", ctypes.c_uint32),
+        ("dirattr", ctypes.c_uint32),
+        ("fileattr", ctypes.c_uint32),
+        ("forkattr", ctypes.c_uint32),
+    ]
+
+
+def _load_getattrlistbulk():
+    """Return libc's getattrlistbulk on macOS, or None if unavailable."""
+    if sys.platform != "darwin":
+        return None
+    try:
+        func = ctypes.CDLL(None, use_errno=True).getattrlistbulk
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.POINTER(_AttrList), ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint64]
+    func.restype = ctypes.c_int
+    return func
+
+
+_getattrlistbulk = _load_getattrlistbulk()
+
+
+def _bulk_scandir(path, want_size):
+    """Like _scandir_entries, but fetches names, types and sizes of many entries per syscall (macOS only)."""
+    attrs = _AttrList(
+        bitmapcount=_ATTR_BIT_MAP_COUNT,
+        commonattr=_ATTR_CMN_RETURNED_ATTRS | _ATTR_CMN_NAME | _ATTR_CMN_OBJTYPE,
+        fileattr=_ATTR_FILE_DATALENGTH if want_size else 0,
+    )
+    buf = ctypes.create_string_buffer(_BULK_BUFFER_SIZE)
+    prefix = os.path.join(path, "")
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        while True:
+            count = _getattrlistbulk(fd, ctypes.byref(attrs), buf, _BULK_BUFFER_SIZE, 0)
+            if count < 0:
+                err = ctypes.get_errno()
+                raise OSError(err, os.strerror(err), path)
+            if count == 0:
                 return
-            candidates.append((k, path))
-        # else: broken symlink, etc. skip
+            pos = 0
+            for _ in range(count):
+                # Each entry: u_int32 length, attribute_set_t returned (5 x u_int32),
+                # attrreference_t name, fsobj_type_t objtype, then off_t datalength if returned.
+                # The data fork length matches st_size; the total size would add other forks.
+                length, common, _vol, _dir, fileattr, _fork = struct.unpack_from("<6I", buf, pos)
+                field = pos + 24
+                name_off, name_len = struct.unpack_from("<iI", buf, field)
+                name = os.fsdecode(buf[field + name_off:field + name_off + name_len - 1])
+                field += 8
+                objtype = struct.unpack_from("<I", buf, field)[0] if common & _ATTR_CMN_OBJTYPE else 0
+                field += 4
+                size = 0
+                if fileattr & _ATTR_FILE_DATALENGTH:
+                    size = struct.unpack_from("<q", buf, field)[0]
+                pos += length
+                entry_path = prefix + name
+                if objtype == _VDIR:
+                    yield name, entry_path, True, False, 0
+                elif objtype == _VREG:
+                    yield name, entry_path, False, True, size
+                elif objtype == _VLNK:
+                    # Follow the link, as os.scandir's DirEntry.is_file() does.
+                    try:
+                        st = os.stat(entry_path)
+                    except OSError:
+                        yield name, entry_path, False, False, 0
+                        continue
+                    is_file = stat.S_ISREG(st.st_mode)
+                    yield name, entry_path, False, is_file, st.st_size if is_file and want_size else 0
+                else:
+                    yield name, entry_path, False, False, 0
+    finally:
+        os.close(fd)
+
+
+_scandir = _bulk_scandir if _getattrlistbulk is not None else _scandir_entries
+
+
+def _iter_zip_members_lite(path):
+    """Yield (filename, file_size) for each non-directory member of a zip file, reading only its central directory.
+
+    The file is memory-mapped and no ZipInfo objects are built; directory entries are
+    recognized from the raw name bytes and never decoded. Names are decoded as zipfile
+    does. Raises ValueError (or struct.error) if the archive is not laid out as expected,
+    and OSError if the file cannot be memory-mapped.
+    """
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        view = memoryview(mm)
+        try:
+            size = len(mm)
+            # End of central directory record: at the very end unless there is an archive comment.
+            eocd = size - _ZIP_EOCD_SIZE
+            if eocd < 0 or mm[eocd:eocd + 4] != _ZIP_EOCD_SIG:
+                eocd = mm.rfind(_ZIP_EOCD_SIG, max(0, size - _ZIP_EOCD_SIZE - 0xFFFF))
+                if eocd < 0:
+                    raise ValueError("end of central directory not found")
+            count, cd_size, cd_offset = struct.unpack_from("<10xHLL", mm, eocd)
+            cd_end = eocd
+            if count == 0xFFFF or cd_size == 0xFFFFFFFF or cd_offset == 0xFFFFFFFF:
+                locator = eocd - _ZIP_EOCD64_LOCATOR_SIZE
+                cd_end = locator - _ZIP_EOCD64_SIZE
+                if cd_end < 0 or mm[locator:locator + 4] != _ZIP_EOCD64_LOCATOR_SIG or mm[cd_end:cd_end + 4] != _ZIP_EOCD64_SIG:
+                    raise ValueError("zip64 end of central directory not found")
+                count, cd_size, cd_offset = struct.unpack_from("<3Q", mm, cd_end + 32)
+            # Like zipfile, locate the central directory relative to its end so that data
+            # prepended to the archive (e.g. a self-extractor) does not matter.
+            pos = cd_end - cd_size
+            if pos < 0:
+                raise ValueError("bad central directory offset")
+            parsed = 0
+            while pos < cd_end:
+                if pos + _ZIP_CD_SIZE > cd_end:
+                    raise ValueError("truncated central directory")
+                sig, flags, file_size, name_len, extra_len, comment_len = struct.unpack_from("<I4xH14xI3H", mm, pos)
+                if sig != _ZIP_CD_SIG:
+                    raise ValueError("bad central directory header")
+                name_start = pos + _ZIP_CD_SIZE
+                name_end = name_start + name_len
+                pos = name_end + extra_len + comment_len
+                if pos > cd_end:
+                    raise ValueError("bad central directory header")
+                parsed += 1
+                if name_len and view[name_end - 1] == 0x2F:  # "/": a directory
+                    continue
+                filename = str(view[name_start:name_end], "utf-8" if flags & 0x800 else "cp437")
+                if "\0" in filename:
+                    filename = filename[:filename.index("\0")]
+                    if filename.endswith("/"):
+                        continue
+                if os.sep != "/":
+                    filename = filename.replace(os.sep, "/")
+                if file_size == 0xFFFFFFFF:
+                    file_size = _zip64_file_size(mm, name_end, name_end + extra_len, file_size)
+                yield filename, file_size
+            if parsed != count:
+                raise ValueError("central directory entry count mismatch")
+        finally:
+            view.release()
+
+
+def _zip64_file_size(mm, start, end, default):
+    """Uncompressed size from the zip64 extra field between start and end, or default if absent."""
+    while start + 4 <= end:
+        field_id, field_len = struct.unpack_from("<HH", mm, start)
+        if field_id == 0x0001 and field_len >= 8:
+            return struct.unpack_from("<Q", mm, start + 4)[0]
+        start += 4 + field_len
+    return default
+
+
+def _zip_members(path):
+    """Yield (filename, file_size) for each non-directory member of a zip file.
+
+    Uses _iter_zip_members_lite, falling back to zipfile if the lightweight parse fails.
+    Both list members in central directory order, so a fallback part way through
+    resumes after the members already yielded.
+    """
+    yielded = 0
+    try:
+        for member in _iter_zip_members_lite(path):
+            yield member
+            yielded += 1
+        return
+    except (OSError, ValueError, struct.error):
+        pass
+    with zipfile.ZipFile(path, "r") as zf:
+        files = (info for info in zf.infolist() if not info.is_dir())
+        for info in itertools.islice(files, yielded, None):
+            yield info.filename, info.file_size
+
 
+def _zip_candidates(path, by_size, exclude_re, include_re):
+    """Yield (weight, path + ZIP_SEP + member) for each member of the zip file that is a candidate."""
+    try:
+        for member_path, file_size in _zip_members(path):
+            if not member_path:
+                continue
+            member_basename = _basename_zip(member_path)
+            if _should_skip_file_basename(member_basename, exclude_re, include_re):
+                continue
+            if not by_size:
+                yield 1, path + ZIP_SEP + member_path
+            elif file_size > 0:
+                yield file_size, path + ZIP_SEP + member_path
+    except (zipfile.BadZipFile, OSError):
+        pass
+
+
+def iter_candidates(args):
+    """Yield (weight, path) where path may be 'zip_path' + ZIP_SEP + 'member' for zip entries."""
+    exclude_re = _compile_patterns(args.exclude_patterns, "--exclude") if args.exclude_patterns else None
+    include_re = _compile_patterns(args.include_patterns, "--include")
+    # Locals rather than attribute lookups on args in the per-entry loops
+    do_zip = args.zip
+    by_size = args.size
     missing = [fn for fn in args.filenames if not os.path.exists(fn)]
     if missing:
         sys.stderr.write(f"mksample: no such file or directory: {', '.join(missing)}\n")
         sys.exit(1)
+
+    # Worklist of directories still to be listed, and the files found by the
+    # most recent listing as (path, basename, weight). The weight is settled, and
+    # empty files dropped when sampling by size, as soon as the size is known.
+    # Only the top-level arguments need abspath and basename; everything below
+    # them uses the names, paths, types and sizes that _scandir returns from the
+    # directory read.
+    stack = []
+    files = []
     for fn in args.filenames:
-        visit(os.path.abspath(fn))
+        path = os.path.abspath(fn)
+        basename = _basename_fs(path)
+        if os.path.isdir(path):
+            if not _should_skip_traversal(basename, exclude_re):
+                stack.append(path)
+        elif os.path.isfile(path):
+            if not by_size:
+                files.append((path, basename, 1))
+                continue
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                continue
+            if size > 0:
+                files.append((path, basename, size))
+
+    while True:
+        for path, basename, k in files:
+            if do_zip and basename.lower().endswith(".zip"):
+                if not _should_skip_traversal(basename, exclude_re):
+                    yield from _zip_candidates(path, by_size, exclude_re, include_re)
+                continue
+            if _should_skip_file_basename(basename, exclude_re, include_re):
+                continue
+            yield k, path
+
+        if not stack:
+            break
+        dirpath = stack.pop()
+        files = []
+        # Read the whole listing first, like os.walk, so a .mksample.skip file
+        # is found without a separate stat. Sorted so that candidates come out in
+        # the same order on every run, which --seed relies on.
+        try:
+            entries = sorted(_scandir(dirpath, by_size))
+        except OSError:
+            continue
+        if any(is_file and name == MKSAMPLE_SKIP_FILE for name, _, _, is_file, _ in entries):
+            continue
+        subdirs = []
+        for name, path, is_dir, is_file, size in entries:
+            if is_dir:
+                if not _should_skip_traversal(name, exclude_re):
+                    subdirs.append(path)
+            elif is_file:
+                if not by_size:
+                    files.append((path, name, 1))
+                elif size > 0:
+                    files.append((path, name, size))
+            # else: broken symlink, symlink to directory, etc. skip
+        # Reversed so that subdirectories are popped in listing order.
+        stack.extend(reversed(subdirs))
 
-    return candidates
 
+def stage1_collect_candidates(args):
+    """Produce list of (weight, path); see iter_candidates."""
+    return list(iter_candidates(args))
+
+
+def _es_keys(weights, u):
+    """Efraimidis-Spirakis keys log(u)/k for arrays of weights k and uniforms u; overwrites u."""
+    # Computed in place in u with vectorized log: no per-item math.log calls. The only
+    # temporary is the boolean mask that leaves keys for non-positive weights as log(u).
+    np.maximum(u, RANDOM_EPSILON, out=u)
+    np.log(u, out=u)
+    np.divide(u, weights, out=u, where=weights > 0)
+    return u
+
+
+def _sample_numpy(candidates, n, rng):
+    """Top n of candidates by Efraimidis-Spirakis key, computing keys one vectorized chunk at a time.
+
+    rng is a numpy.random.Generator.
+    """
+    # Keys live in flat arrays; paths are kept only for the current top n and the chunk being merged.
+    best_keys = np.empty(0)
+    best_paths = []
+    while True:
+        chunk = list(itertools.islice(candidates, SAMPLE_CHUNK_SIZE))
+        if not chunk:
+            return best_paths
+        weights = np.fromiter((k for k, _ in chunk), dtype=np.float64, count=len(chunk))
+        keys = np.concatenate((best_keys, _es_keys(weights, rng.random(len(chunk)))))
+        paths = best_paths + [path for _, path in chunk]
+        if len(paths) > n:
+            idx = np.argpartition(keys, -n)[-n:]
+            best_keys = keys[idx]
+            best_paths = [paths[i] for i in idx.tolist()]
+        else:
+            best_keys, best_paths = keys, paths
 
-def stage2_sample(candidates, n):
-    """Efraimidis-Spirakis with min-heap: key = log(r)/k, keep top n by key."""
-    if not candidates:
-        return []
-    n = min(n, len(candidates))
-    if n == 0:
-        return []
+
+def _sample_expj(candidates, n, rng):
+    """Top n of candidates by Efraimidis-Spirakis key, using exponential jumps (A-ExpJ, no NumPy).
+
+    Once the min-heap holds n items, one random number decides how much weight to skip
+    before the next item that enters the heap, so most candidates cost only a subtraction.
+    rng is a random.Random.
+    """
     # Min-heap of (key, path). We want the n items with largest keys.
     heap = []
     for k, path in candidates:
-        r = random.random() or RANDOM_EPSILON
+        r = rng.random() or RANDOM_EPSILON
         # key = log(r)/k; larger k => less negative => higher key
-        key = math.log(r) / k if k > 0 else math.log(r)
-        if len(heap) < n:
-            heapq.heappush(heap, (key, path))
-        elif key > heap[0][0]:
-            heapq.heapreplace(heap, (key, path))
-    selected = [path for _, path in heap]
-    random.shuffle(selected)
+        heap.append((math.log(r) / k if k > 0 else math.log(r), path))
+        if len(heap) == n:
+            break
+    else:
+        # Fewer than n candidates: take them all.
+        return [path for _, path in heap]
+    heapq.heapify(heap)
+    threshold = heap[0][0]
+    skip = math.log(rng.random() or RANDOM_EPSILON) / threshold
+    for k, path in candidates:
+        w = k if k > 0 else 1
+        skip -= w
+        if skip > 0:
+            continue
+        # This item enters the heap; its key is conditioned to exceed the threshold.
+        r = rng.uniform(math.exp(threshold * w), 1.0) or RANDOM_EPSILON
+        heapq.heapreplace(heap, (math.log(r) / w, path))
+        threshold = heap[0][0]
+        skip = math.log(rng.random() or RANDOM_EPSILON) / threshold
+    return [path for _, path in heap]
+
+
+def stage2_sample(candidates, n, seed=None):
+    """Efraimidis-Spirakis: key = log(r)/k, keep top n by key.
+
+    candidates may be any iterable of (weight, path), such as iter_candidates(args);
+    it is consumed once and only about n of its items are held in memory.
+    A given seed makes the result reproducible for candidates in the same order
+    (as iter_candidates produces for an unchanged tree), with the same NumPy availability.
+    """
+    if n <= 0:
+        return []
+    it = iter(candidates)
+    if np is not None:
+        # PCG64: random numbers for a whole chunk come from one call.
+        rng = np.random.default_rng(seed)
+        selected = _sample_numpy(it, n, rng)
+    else:
+        rng = random.Random(seed)
+        selected = _sample_expj(it, n, rng)
+    rng.shuffle(selected)
     return selected
 
 
+def _copy_file(src_path, dest):
+    """Copy src_path to a new file dest, in the kernel with copy_file_range where supported."""
+    with open(src_path, "rb") as src:
+        with open(dest, "wb") as out:
+            if hasattr(os, "copy_file_range"):
+                copied = 0
+                try:
+                    while True:
+                        n = os.copy_file_range(src.fileno(), out.fileno(), COPY_BUFFER_SIZE)
+                        if n == 0:
+                            return
+                        copied += n
+                except OSError:
+                    # Unsupported by this kernel or filesystem pair; nothing was written yet.
+                    if copied:
+                        raise
+            shutil.copyfileobj(src, out, COPY_BUFFER_SIZE)
+
+
+def _dest_path(outputdir, i, basename):
+    """Output path for the i'th selected file, whose basename is given."""
+    dn = f"{i // 25:02d}"
+    base = _sanitize_dest_basename(basename)
+    dfn = f"{i:04d} {base}"
+    return os.path.join(outputdir, dn, dfn)
+
+
+def _link_or_copy(fn, dest):
+    """Hard-link fn to dest, copying it when a link is not possible."""
+    try:
+        os.link(fn, dest)
+    except OSError:
+        # Cross-filesystem or permission: fallback to copy
+        _copy_file(fn, dest)
+
+
+def _extract_zip_members(zip_path, members):
+    """Extract each (member_path, dest) of members from one zip file."""
+    with zipfile.ZipFile(zip_path, "r") as zf:
+        for member_path, dest in members:
+            with zf.open(member_path) as src:
+                with open(dest, "wb") as out:
+                    shutil.copyfileobj(src, out, COPY_BUFFER_SIZE)
+
+
 def stage3_produce_sample(selected, outputdir, dryrun, cmdline):
     """Create outputdir and write each selected file (extract from zip or hardlink)."""
     if os.path.exists(outputdir):
@@ -228,27 +628,28 @@ def stage3_produce_sample(selected, outputdir, dryrun, cmdline):
     skip_path = os.path.join(outputdir, MKSAMPLE_SKIP_FILE)
     with open(skip_path, "w") as f:
         f.write(cmdline + "\n")
-    for i, fn in enumerate(selected):
-        dn = f"{i // 25:02d}"
-        subdir = os.path.join(outputdir, dn)
-        os.makedirs(subdir, exist_ok=True)
-        base = _sanitize_dest_basename(_basename(fn))
-        dfn = f"{i:04d} {base}"
-        dest = os.path.join(subdir, dfn)
-        if ZIP_SEP in fn:
-            zip_path, member_path = fn.split(ZIP_SEP, 1)
-            with zipfile.ZipFile(zip_path, "r") as zf:
-                with zf.open(member_path) as src:
-                    with open(dest, "wb") as out:
-                        out.write(src.read())
-        else:
-            try:
-                os.link(fn, dest)
-            except OSError:
-                # Cross-filesystem or permission: fallback to copy
-                with open(fn, "rb") as src:
-                    with open(dest, "wb") as out:
-                        out.write(src.read())
+    # Create every subdirectory before any worker writes into one. outputdir is
+    # new, so a plain mkdir per bucket suffices.
+    num_buckets = (len(selected) + 24) // 25
+    for b in range(num_buckets):
+        os.mkdir(os.path.join(outputdir, f"{b:02d}"))
+    # Group zip members by archive so each zip is opened (and its central directory parsed) once.
+    zip_groups = collections.defaultdict(list)
+    # Linking, copying and inflating overlap across threads: the I/O and zlib release the GIL.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = []
+        for i, fn in enumerate(selected):
+            if ZIP_SEP in fn:
+                zip_path, member_path = fn.split(ZIP_SEP, 1)
+                dest = _dest_path(outputdir, i, _basename_zip(member_path))
+                zip_groups[zip_path].append((member_path, dest))
+            else:
+                dest = _dest_path(outputdir, i, _basename_fs(fn))
+                futures.append(executor.submit(_link_or_copy, fn, dest))
+        for zip_path, members in zip_groups.items():
+            futures.append(executor.submit(_extract_zip_members, zip_path, members))
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
 
 
 def main():
@@ -257,11 +658,10 @@ def main():
         sys.exit(0)
     argv = sys.argv[1:]
     args = parse_args(argv)
-    candidates = stage1_collect_candidates(args)
-    if not candidates:
+    selected = stage2_sample(iter_candidates(args), args.count, args.seed)
+    if not selected:
         sys.stderr.write("mksample: no candidates found\n")
         sys.exit(1)
-    selected = stage2_sample(candidates, args.count)
     cmdline = "mksample " + " ".join(shlex.quote(a) for a in argv)
     stage3_produce_sample(selected, args.output, args.dryrun, cmdline)
 
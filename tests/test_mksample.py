@@ -44,6 +44,13 @@ def test_count_validation():
     assert args.count == 1
     args = m.parse_args(["x", "--output", "o", "--count", "2500"])
     assert args.count == 2500
+    assert args.seed is None
+    args = m.parse_args(["x", "--output", "o", "--seed", "7"])
+    assert args.seed == 7
+    args = m.parse_args(["x", "--output", "o", "--seed", "0"])
+    assert args.seed == 0
+    with pytest.raises(SystemExit):
+        m.parse_args(["x", "--output", "o", "--seed", "-1"])
 
 
 def test_size_uniform_mutually_exclusive():
@@ -51,6 +58,52 @@ def test_size_uniform_mutually_exclusive():
         m.parse_args(["x", "--output", "o", "--size", "--uniform"])
 
 
+def test_compile_patterns_cached(capsys):
+    r1 = m._compile_patterns([r"a\.txt", "b"], "--include")
+    r2 = m._compile_patterns([r"a\.txt", "b"], "--include")
+    assert r1 is r2
+    assert r1.search("a.txt") and r1.search("b") and not r1.search("ab")
+    with pytest.raises(SystemExit):
+        m._compile_patterns(["("], "--exclude")
+    _, err = capsys.readouterr()
+    assert "invalid regular expression for --exclude" in err
+
+
+def test_should_skip_file_basename():
+    exclude_re = m._compile_patterns([r"a.*"], "--exclude")
+    include_re = m._compile_patterns([r".*\.txt"], "--include")
+    assert m._should_skip_file_basename("abc.txt", exclude_re, include_re)  # excluded wins
+    assert not m._should_skip_file_basename("b.txt", exclude_re, include_re)
+    assert m._should_skip_file_basename("b.dat", exclude_re, include_re)  # not included
+    assert m._should_skip_file_basename(".b.txt", exclude_re, include_re)  # hidden
+    assert not m._should_skip_file_basename("abc", None, m._compile_patterns([".*"], "--include"))
+
+
+def test_patterns_with_numbered_backreference(tmp_path):
+    (tmp_path / "aa.txt").write_text("x")
+    (tmp_path / "bb.txt").write_text("x")
+    (tmp_path / "ab.txt").write_text("x")
+
+    class Args:
+        exclude_patterns = []
+        include_patterns = [r"(.)\1\.txt"]
+        size = True
+        zip = False
+        filenames = [str(tmp_path)]
+
+    args = Args()
+    names = {os.path.basename(p) for _, p in m.stage1_collect_candidates(args)}
+    assert names == {"aa.txt", "bb.txt"}
+    args.exclude_patterns = [r"(a)\1\.txt"]
+    names = {os.path.basename(p) for _, p in m.stage1_collect_candidates(args)}
+    assert names == {"bb.txt"}
+
+
+def test_sanitize_dest_basename():
+    assert m._sanitize_dest_basename("a/b\\c\0d\ne\rf.txt") == "a_b_c_d_e_f.txt"
+    assert m._sanitize_dest_basename("plain name.txt") == "plain name.txt"
+
+
 def test_stage1_include_exclude(tmp_path):
     (tmp_path / "a.txt").write_text("a")
     (tmp_path / "b.txt").write_text("b")
@@ -153,6 +206,83 @@ def test_stage1_directory_recursion(tmp_path):
     assert any("sub" in p and "b" in p for p in paths)
 
 
+def test_stage1_weights(tmp_path):
+    (tmp_path / "empty").touch()
+    (tmp_path / "three").write_text("abc")
+
+    class Args:
+        exclude_patterns = []
+        include_patterns = [".*"]
+        size = True
+        zip = False
+        filenames = [str(tmp_path), str(tmp_path / "empty")]
+
+    args = Args()
+    assert [(k, os.path.basename(p)) for k, p in m.stage1_collect_candidates(args)] == [(3, "three")]
+    args.size = False
+    cands = sorted((os.path.basename(p), k) for k, p in m.stage1_collect_candidates(args))
+    assert cands == [("empty", 1), ("empty", 1), ("three", 1)]
+
+
+@pytest.mark.skipif(sys.platform != "darwin" or m._getattrlistbulk is None, reason="getattrlistbulk is macOS only")
+@pytest.mark.parametrize("want_size", [True, False])
+def test_bulk_scandir_matches_scandir(tmp_path, want_size):
+    (tmp_path / "empty").touch()
+    (tmp_path / "file.txt").write_text("x" * 1000)
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "nested").write_text("y")
+    (tmp_path / "link_to_file").symlink_to(tmp_path / "file.txt")
+    (tmp_path / "link_to_dir").symlink_to(tmp_path / "sub")
+    (tmp_path / "broken").symlink_to(tmp_path / "missing")
+    expected = sorted(m._scandir_entries(str(tmp_path), want_size))
+    assert sorted(m._bulk_scandir(str(tmp_path), want_size)) == expected
+
+
+def test_stage1_symlinked_directory_not_followed(tmp_path):
+    outside = tmp_path / "outside"
+    outside.mkdir()
+    (outside / "elsewhere.txt").write_text("x")
+    root = tmp_path / "root"
+    root.mkdir()
+    (root / "here.txt").write_text("x")
+    (root / "linked_dir").symlink_to(outside)
+    (root / "linked_file.txt").symlink_to(outside / "elsewhere.txt")
+
+    class Args:
+        exclude_patterns = []
+        include_patterns = [".*"]
+        size = True
+        zip = False
+        filenames = [str(root)]
+
+    args = Args()
+    names = {os.path.basename(p) for _, p in m.stage1_collect_candidates(args)}
+    assert names == {"here.txt", "linked_file.txt"}
+    # A symlinked directory given on the command line is still visited
+    args.filenames = [str(root / "linked_dir")]
+    names = {os.path.basename(p) for _, p in m.stage1_collect_candidates(args)}
+    assert names == {"elsewhere.txt"}
+
+
+def test_stage1_order_independent_of_listing_order(monkeypatch, tmp_path):
+    for name in ("c", "a", "b"):
+        (tmp_path / name).write_text(name)
+        (tmp_path / f"dir_{name}").mkdir()
+        (tmp_path / f"dir_{name}" / "f").write_text(name)
+
+    class Args:
+        exclude_patterns = []
+        include_patterns = [".*"]
+        size = True
+        zip = False
+        filenames = [str(tmp_path)]
+
+    first = m.stage1_collect_candidates(Args())
+    scandir = m._scandir
+    monkeypatch.setattr(m, "_scandir", lambda path, want_size: reversed(list(scandir(path, want_size))))
+    assert m.stage1_collect_candidates(Args()) == first
+
+
 def test_stage2_sample_count():
     # More candidates than count
     candidates = [(1, "a"), (1, "b"), (1, "c"), (1, "d"), (1, "e")]
@@ -173,6 +303,59 @@ def test_stage2_uniform_vs_size():
     assert len(set(selected)) == 2
 
 
+@pytest.mark.parametrize("use_numpy", [True, False])
+def test_stage2_weighting(monkeypatch, use_numpy):
+    if use_numpy and m.np is None:
+        pytest.skip("numpy not installed")
+    if not use_numpy:
+        monkeypatch.setattr(m, "np", None)
+    candidates = [(10**9, "big")] + [(1, f"small{i}") for i in range(100)]
+    assert m.stage2_sample(candidates, 1) == ["big"]
+    selected = m.stage2_sample(candidates, 50)
+    assert len(set(selected)) == 50
+    assert "big" in selected
+
+
+@pytest.mark.parametrize("use_numpy", [True, False])
+def test_stage2_streams_iterable(monkeypatch, use_numpy):
+    if use_numpy and m.np is None:
+        pytest.skip("numpy not installed")
+    if not use_numpy:
+        monkeypatch.setattr(m, "np", None)
+    monkeypatch.setattr(m, "SAMPLE_CHUNK_SIZE", 3)
+    selected = m.stage2_sample(((1, f"f{i}") for i in range(10)), 4)
+    assert len(set(selected)) == 4
+    assert set(selected) <= {f"f{i}" for i in range(10)}
+    assert sorted(m.stage2_sample(((1, f"f{i}") for i in range(2)), 4)) == ["f0", "f1"]
+    assert m.stage2_sample(iter(()), 4) == []
+
+
+@pytest.mark.parametrize("use_numpy", [True, False])
+def test_stage2_seed_reproducible(monkeypatch, use_numpy):
+    if use_numpy and m.np is None:
+        pytest.skip("numpy not installed")
+    if not use_numpy:
+        monkeypatch.setattr(m, "np", None)
+    candidates = [(i % 7 + 1, f"f{i}") for i in range(1000)]
+    first = m.stage2_sample(candidates, 20, seed=42)
+    assert m.stage2_sample(candidates, 20, seed=42) == first
+    assert m.stage2_sample(candidates, 20, seed=43) != first
+
+
+def test_es_keys():
+    np = pytest.importorskip("numpy")
+    weights = np.array([1.0, 2.0, 1000.0, 0.0, 5.0])
+    u = np.array([0.5, 0.0, 0.25, 0.75, 1 - 2**-53])
+    expected = [
+        np.log(0.5),
+        np.log(m.RANDOM_EPSILON) / 2.0,
+        np.log(0.25) / 1000.0,
+        np.log(0.75),
+        np.log(1 - 2**-53) / 5.0,
+    ]
+    np.testing.assert_allclose(m._es_keys(weights, u), expected)
+
+
 def test_stage3_dryrun(capsys, tmp_path):
     (tmp_path / "f1").write_text("x")
     (tmp_path / "f2").write_text("y")
@@ -226,6 +409,21 @@ def test_stage3_output_layout(tmp_path):
     assert any("two" in f for f in names)
 
 
+def test_stage3_copies_when_link_fails(monkeypatch, tmp_path):
+    src = tmp_path / "one"
+    src.write_bytes(os.urandom(3 * m.COPY_BUFFER_SIZE + 7))
+    outdir = tmp_path / "out"
+
+    def no_link(*args, **kwargs):
+        raise OSError("cross-device link")
+
+    monkeypatch.setattr(m.os, "link", no_link)
+    m.stage3_produce_sample([str(src)], str(outdir), False, "mksample")
+    outfile = outdir / "00" / "0000 one"
+    assert outfile.read_bytes() == src.read_bytes()
+    assert os.stat(outfile).st_ino != os.stat(src).st_ino
+
+
 def test_stage3_output_dir_exists_fails(tmp_path):
     (tmp_path / "f").write_text("x")
     outdir = tmp_path / "out"
@@ -257,6 +455,69 @@ def test_zip_candidates(tmp_path):
     assert "x.txt" in path
 
 
+def test_zip_members_lite_matches_zipfile(tmp_path):
+    zippath = tmp_path / "a.zip"
+    with zipfile.ZipFile(zippath, "w") as zf:
+        zf.writestr("d/", "")
+        zf.writestr("d/x.txt", "abc")
+        zf.writestr("\u00fcn\u00ef.txt", "abcd" * 100)
+        zf.comment = b"archive comment"
+    # Data prepended to the archive, as in a self-extractor
+    prefixed = tmp_path / "b.zip"
+    prefixed.write_bytes(b"#!/bin/sh\n" + zippath.read_bytes())
+    for p in (zippath, prefixed):
+        with zipfile.ZipFile(p) as zf:
+            expected = [(i.filename, i.file_size) for i in zf.infolist() if not i.is_dir()]
+        assert list(m._iter_zip_members_lite(str(p))) == expected
+
+
+def test_zip_members_corrupt_header_falls_back(tmp_path):
+    zippath = tmp_path / "a.zip"
+    with zipfile.ZipFile(zippath, "w") as zf:
+        zf.writestr("a.txt", "aaa")
+        zf.writestr("b.txt", "bb")
+    data = bytearray(zippath.read_bytes())
+    # Corrupt the file name length of the last central directory header
+    header = data.rfind(b"PK\x01\x02")
+    data[header + 28:header + 30] = (60000).to_bytes(2, "little")
+    zippath.write_bytes(bytes(data))
+    with pytest.raises(ValueError):
+        list(m._iter_zip_members_lite(str(zippath)))
+    with zipfile.ZipFile(zippath) as zf:
+        expected = [(i.filename, i.file_size) for i in zf.infolist() if not i.is_dir()]
+    assert list(m._zip_members(str(zippath))) == expected
+
+    class Args:
+        exclude_patterns = []
+        include_patterns = [".*"]
+        size = True
+        zip = True
+        filenames = [str(tmp_path)]
+
+    names = {p.split(m.ZIP_SEP, 1)[1] for _, p in m.stage1_collect_candidates(Args())}
+    assert names == {"a.txt", "b.txt"}
+
+
+def test_zip_members_mmap_failure_falls_back(monkeypatch, tmp_path):
+    zippath = tmp_path / "a.zip"
+    with zipfile.ZipFile(zippath, "w") as zf:
+        zf.writestr("a.txt", "aaa")
+
+    def no_mmap(*args, **kwargs):
+        raise OSError("mmap not supported")
+
+    monkeypatch.setattr(m.mmap, "mmap", no_mmap)
+    assert list(m._zip_members(str(zippath))) == [("a.txt", 3)]
+
+
+def test_zip_not_a_zip(tmp_path):
+    bogus = tmp_path / "bogus.zip"
+    bogus.write_bytes(b"not a zip file")
+    (tmp_path / "empty.zip").touch()
+    assert list(m._zip_candidates(str(bogus), True, None, m._compile_patterns([".*"]))) == []
+    assert list(m._zip_candidates(str(tmp_path / "empty.zip"), True, None, m._compile_patterns([".*"]))) == []
+
+
 def test_zip_extract_in_stage3(tmp_path):
     zippath = tmp_path / "a.zip"
     with zipfile.ZipFile(zippath, "w") as zf:
@@ -270,6 +531,24 @@ def test_zip_extract_in_stage3(tmp_path):
     assert outfile.read_text() == "content"
 
 
+def test_zip_extract_several_members(tmp_path):
+    zippath = tmp_path / "a.zip"
+    with zipfile.ZipFile(zippath, "w") as zf:
+        zf.writestr("one.txt", "1")
+        zf.writestr("sub/two.txt", "2")
+    (tmp_path / "plain.txt").write_text("p")
+    selected = [
+        str(zippath) + m.ZIP_SEP + "sub/two.txt",
+        str(tmp_path / "plain.txt"),
+        str(zippath) + m.ZIP_SEP + "one.txt",
+    ]
+    outdir = tmp_path / "out"
+    m.stage3_produce_sample(selected, str(outdir), False, "mksample")
+    assert (outdir / "00" / "0000 two.txt").read_text() == "2"
+    assert (outdir / "00" / "0001 plain.txt").read_text() == "p"
+    assert (outdir / "00" / "0002 one.txt").read_text() == "1"
+
+
 def test_empty_candidates_exits(capsys, tmp_path):
     sys.argv = ["mksample", str(tmp_path), "--output", str(tmp_path / "out")]
     with pytest.raises(SystemExit) as exc: